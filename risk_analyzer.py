@@ -4,20 +4,91 @@ Fetches real-time data from Etherscan API and generates normalized risk scores (
 Author: Mohammed Faris Sait
 """
 
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
-from datetime import datetime
-import requests
+import aiohttp
+import asyncio
+import orjson
+from aiolimiter import AsyncLimiter
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential
 import time
-import concurrent.futures
 import os
-from dotenv import load_dotenv
-load_dotenv()
-ETHERSCAN_API_KEY = os.getenv("ETHERSCAN_API_KEY")
+import shelve
+from contextlib import nullcontext
+import csv
+from typing import Optional
+
+# Optional: faster CSV reader for wallet lists, pandas is used when it is not installed
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = pacsv = None
+
+COMPOUND_V2_SUBGRAPH_URL = "https://api.thegraph.com/subgraphs/name/graphprotocol/compound-v2"
+# Max addresses per GraphQL `_in` filter and max entities per page
+SUBGRAPH_CHUNK_SIZE = 1000
+# Parsed Etherscan summaries are reused from the on-disk cache for up to an hour
+CACHE_EXPIRE_SECONDS = 3600
+# Bumped whenever the summary dict layout changes, so stale cache entries are not reused
+SUMMARY_FORMAT = 2
+
+
+class EtherscanError(RuntimeError):
+    """Raised when a wallet's Etherscan data cannot be fetched, including after all retries."""
+
+
+class EtherscanRateLimitError(EtherscanError):
+    """Raised when Etherscan rejects a request for exceeding the API rate limit."""
+
+
+def is_rate_limited(data: dict) -> bool:
+    """Checks whether an Etherscan response was rejected by the rate limiter."""
+    return data.get('status') != '1' and 'rate limit' in f"{data.get('message')} {data.get('result')}".lower()
+
+
+# Transient HTTP statuses worth retrying (throttling and gateway/server errors)
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Checks whether a failed Etherscan request should be retried with backoff."""
+    # Rate limit rejections, dropped/refused connections and timeouts are all transient
+    if isinstance(exc, (EtherscanRateLimitError, aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        return True
+    return isinstance(exc, aiohttp.ClientResponseError) and exc.status in RETRY_STATUSES
+
+
+def get_requests_per_second() -> float:
+    """Reads the allowed Etherscan request rate from ETHERSCAN_RPS (default 5, the free tier)."""
+    value = os.getenv("ETHERSCAN_RPS", "5")
+    try:
+        requests_per_second = float(value)
+    except ValueError:
+        raise ValueError(f"ETHERSCAN_RPS must be a positive number of requests per second, got {value!r}") from None
+    if not 0 < requests_per_second < float('inf'):
+        raise ValueError(f"ETHERSCAN_RPS must be a positive number of requests per second, got {value!r}")
+    return requests_per_second
+
 
 def get_wallet_addresses(file_path: str) -> list:
     """Loads wallet addresses from the specified CSV file."""
     try:
+        if pacsv is not None:
+            with open(file_path, newline='', encoding='utf-8-sig') as f:
+                header = next(csv.reader(f), [])
+            if not header:
+                return []
+            # Same column preference as below: wallet_id, then address, then the first column
+            column = next((name for name in ('wallet_id', 'address') if name in header), header[0])
+            # Read only that column, as strings (short 0x... values would otherwise be inferred as
+            # integers) with empty cells as nulls, so the result matches the pandas path
+            convert_options = pacsv.ConvertOptions(column_types={column: pa.string()}, strings_can_be_null=True,
+                                                   include_columns=[column])
+            table = pacsv.read_csv(file_path, read_options=pacsv.ReadOptions(use_threads=True),
+                                   convert_options=convert_options)
+            return table[column].drop_null().unique().to_pylist()
+
         df = pd.read_csv(file_path)
         # Check for wallet_id column first
         if 'wallet_id' in df.columns:
@@ -52,140 +123,373 @@ def get_compound_v2_ctokens():
     }
 
 
-def fetch_real_transactions(wallet_address: str, api_key: str) -> pd.DataFrame:
-    """Fetches real transaction data for a single wallet from the Etherscan API."""
-    print(f"Fetching transactions for {wallet_address}...")
-    API_URL = "https://api.etherscan.io/api"
-    params = {
-        "module": "account", "action": "tokentx", "address": wallet_address,
-        "startblock": 0, "endblock": 99999999, "sort": "asc", "apikey": api_key,
+# Built once at import: lowercase address -> token info, plus a set for O(1) membership checks
+_CTOKEN_MAP = {address.lower(): info for address, info in get_compound_v2_ctokens().items()}
+_CTOKEN_SET = frozenset(_CTOKEN_MAP)
+# Per-token attributes as Series indexed by address, for vectorized column mapping
+_CTOKEN_DECIMALS = pd.Series({address: info['underlying_decimals'] for address, info in _CTOKEN_MAP.items()})
+_CTOKEN_PRICES = pd.Series({address: info['price_usd'] for address, info in _CTOKEN_MAP.items()})
+# Small integer code per cToken (0-5): bit position in a wallet's asset bitmask
+_CTOKEN_CODE = {address: code for code, address in enumerate(_CTOKEN_MAP)}
+_CTOKEN_CODES = pd.Series(_CTOKEN_CODE, dtype='uint8')
+# On-chain decimals of every cToken (transfer values are in these units, not the underlying token's)
+_CTOKEN_TRANSFER_DECIMALS = 8
+# Subgraph events identify the cToken by symbol rather than address
+_CTOKEN_BY_SYMBOL = {info['symbol']: info for info in _CTOKEN_MAP.values()}
+_CTOKEN_SYMBOL_CODE = {_CTOKEN_MAP[address]['symbol']: code for address, code in _CTOKEN_CODE.items()}
+
+
+def empty_summary() -> dict:
+    """Returns the transaction summary of a wallet with no Compound V2 activity."""
+    return {'supplied_usd': 0.0, 'min_ts': None, 'asset_mask': 0, 'n_tx': 0}
+
+
+def aggregate_transfers(is_mint: np.ndarray, value_usd: np.ndarray, sym_code: np.ndarray,
+                        ts: np.ndarray) -> tuple:
+    """Aggregates typed per-transfer arrays into (supplied USD, first timestamp, cToken bitmask)."""
+    supplied_usd = float(np.dot(is_mint, value_usd))
+    min_ts = int(ts.min())
+    # One bit per cToken code (6 tokens fit in a byte)
+    asset_mask = int(np.bitwise_or.reduce(np.left_shift(np.uint8(1), sym_code)))
+    return supplied_usd, min_ts, asset_mask
+
+
+def parse_token_values(values: pd.Series) -> np.ndarray:
+    """Bulk-parses raw integer token amounts (decimal strings) into a float64 array."""
+    # Up to 18 digits always fits int64 and is parsed in one vectorized call;
+    # longer amounts would overflow it, so only those rows go through Python's arbitrary-precision int
+    long_rows = (values.str.len() > 18).to_numpy()
+    # copy=True: under copy-on-write to_numpy() can return a read-only view, and long rows are written below
+    parsed = pd.to_numeric(values.mask(long_rows)).to_numpy(dtype=np.float64, copy=True)
+    if long_rows.any():
+        parsed[long_rows] = [float(int(value)) for value in values[long_rows]]
+    return parsed
+
+
+def summarize_transactions(transactions: list, wallet_address: str) -> dict:
+    """Reduces a wallet's raw Etherscan token transfers to a summary of its Compound V2 activity."""
+    if not transactions:
+        return empty_summary()
+
+    raw = pd.DataFrame(transactions, columns=['contractAddress', 'value', 'timeStamp', 'to'])
+    # Etherscan returns addresses in lowercase, so columns are compared as-is (cheap spot check on one row)
+    for column in ('contractAddress', 'to'):
+        value = raw.at[0, column]
+        if not isinstance(value, str) or value != value.lower():
+            raise EtherscanError(f"Expected a lowercase '{column}' address from Etherscan for {wallet_address}, got {value!r}")
+    # Only process Compound V2 cToken transactions
+    raw = raw.loc[raw['contractAddress'].isin(_CTOKEN_SET)]
+    if raw.empty:
+        return empty_summary()
+
+    wallet_lower = wallet_address.lower()
+    contracts = raw['contractAddress']
+    # Adjust for token decimals
+    value_adjusted = parse_token_values(raw['value']) / 10.0 ** contracts.map(_CTOKEN_DECIMALS).to_numpy()
+    value_usd = value_adjusted * contracts.map(_CTOKEN_PRICES).to_numpy(dtype=np.float64)
+    # Transfers into the wallet are mints (supply), transfers out are redeems
+    is_mint = raw['to'].to_numpy() == wallet_lower
+    sym_code = contracts.map(_CTOKEN_CODES).to_numpy(dtype=np.uint8)
+    ts = raw['timeStamp'].to_numpy(dtype=np.int64)
+
+    supplied_usd, min_ts, asset_mask = aggregate_transfers(is_mint, value_usd, sym_code, ts)
+    return {
+        'supplied_usd': supplied_usd,
+        'min_ts': min_ts,
+        'asset_mask': asset_mask,
+        'n_tx': len(raw),
     }
 
-    try:
-        response = requests.get(API_URL, params=params)
-        response.raise_for_status()
-        data = response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"  > API Request failed for {wallet_address}: {e}")
-        return pd.DataFrame()
-
-    if data['status'] != '1':
-        return pd.DataFrame()
-
-    # Get Compound V2 token addresses
-    ctoken_map = get_compound_v2_ctokens()
-    ctoken_addresses = list(ctoken_map.keys())
-
-    transactions = []
-    for tx in data['result']:
-        contract_address = tx['contractAddress'].lower()
-        # Only process Compound V2 cToken transactions
-        if contract_address in ctoken_addresses:
-            token_info = ctoken_map[contract_address]
-            value_raw = int(tx['value'])
-            # Adjust for token decimals
-            value_adjusted = value_raw / (10 ** token_info['underlying_decimals'])
-            # Determine if it's a mint or redeem transaction
-            event_type = 'Mint' if tx['to'].lower() == wallet_address.lower() else 'Redeem'
-
-            transactions.append({
-                'timestamp': datetime.fromtimestamp(int(tx['timeStamp'])),
-                'event_type': event_type,
-                'asset_symbol': token_info['symbol'],
-                'value_usd': value_adjusted * token_info['price_usd'],
-            })
 
-    if not transactions:
-        return pd.DataFrame()
+async def request_tokentx(session: aiohttp.ClientSession, limiter: AsyncLimiter, params: dict) -> list:
+    """Requests token transfers from the Etherscan API, retrying throttled calls, and returns the result list."""
+    API_URL = "https://api.etherscan.io/api"
+    wallet_address = params['address']
+    # Retry with exponential backoff on rate limit hits and transient HTTP errors
+    async for attempt in AsyncRetrying(retry=retry_if_exception(is_retryable),
+                                       wait=wait_exponential(multiplier=0.2, max=2),
+                                       stop=stop_after_attempt(4), reraise=True):
+        with attempt:
+            async with limiter:
+                async with session.get(API_URL, params=params) as response:
+                    response.raise_for_status()
+                    data = orjson.loads(await response.read())
+            if is_rate_limited(data):
+                raise EtherscanRateLimitError(f"Rate limit exceeded for {wallet_address}: {data.get('result')}")
+
+    if data['status'] == '1':
+        return data['result']
+    # Wallets without any (matching) token transfers are a valid, empty result
+    if data.get('message') == 'No transactions found':
+        return []
+    raise EtherscanError(f"Etherscan API error for {wallet_address}: {data.get('message')} - {data.get('result')}")
 
-    return pd.DataFrame(transactions)
 
+async def fetch_real_transactions_async(session: aiohttp.ClientSession, limiter: AsyncLimiter,
+                                       wallet_address: str, api_key: str,
+                                       cache: Optional[shelve.Shelf] = None,
+                                       filter_server_side: bool = False) -> dict:
+    """Fetches a wallet's transactions from the Etherscan API and summarizes its Compound V2 activity.
 
-def fetch_wallet_data_wrapper(args):
-    """Helper function to unpack arguments for parallel execution."""
-    address, api_key = args
-    return address, fetch_real_transactions(address, api_key)
+    If a cache shelf is given, summaries fetched within CACHE_EXPIRE_SECONDS are served from it
+    without calling the API. With filter_server_side=True, one request per cToken is issued with
+    Etherscan's contractaddress filter instead of downloading the wallet's full transfer history.
+    """
+    params = {
+        "module": "account", "action": "tokentx", "address": wallet_address,
+        "startblock": 0, "endblock": 99999999, "sort": "asc", "apikey": api_key,
+    }
 
+    # The block range is part of the key, so changing endblock invalidates cached entries. The fetch mode is
+    # too: Etherscan caps tokentx at 10,000 rows per call, so for very active wallets one unfiltered request
+    # can miss cToken transfers that the per-cToken requests would return
+    fetch_mode = 'filtered' if filter_server_side else 'all'
+    cache_key = f"{wallet_address.lower()}:{params['startblock']}:{params['endblock']}:{fetch_mode}:{SUMMARY_FORMAT}"
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None and time.time() - cached['saved_at'] < CACHE_EXPIRE_SECONDS:
+            print(f"Using cached transactions for {wallet_address}.")
+            return cached['summary']
+
+    if filter_server_side:
+        # Six small responses instead of one carrying every ERC-20 transfer of the wallet
+        requests_params = [{**params, "contractaddress": ctoken_address} for ctoken_address in _CTOKEN_MAP]
+    else:
+        requests_params = [params]
 
-def calculate_features(df: pd.DataFrame) -> dict:
-    """Calculates risk features from a wallet's transaction history."""
-    if df.empty:
+    print(f"Fetching transactions for {wallet_address}...")
+    try:
+        results = await asyncio.gather(*[request_tokentx(session, limiter, p) for p in requests_params])
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+        # HTTP errors are reduced to status and reason: their repr includes the request URL with the API key
+        reason = f"HTTP {e.status} {e.message}" if isinstance(e, aiohttp.ClientResponseError) else repr(e)
+        # Same policy as a persistent rate limit: never score an unfetched wallet as inactive
+        raise EtherscanError(f"API request failed for {wallet_address} after retries: {reason}") from e
+
+    transactions = [tx for result in results for tx in result]
+    summary = summarize_transactions(transactions, wallet_address)
+
+    # Only successful responses are cached; failed requests are retried on the next run
+    if cache is not None:
+        cache[cache_key] = {'saved_at': time.time(), 'summary': summary}
+    return summary
+
+
+async def query_subgraph_events(session: aiohttp.ClientSession, entity: str, address_field: str,
+                                addresses: list) -> list:
+    """Pages through all mint or redeem events of the given addresses on the Compound V2 subgraph."""
+    query = f"""
+    query($addresses: [Bytes!], $lastId: ID!) {{
+      events: {entity}(first: {SUBGRAPH_CHUNK_SIZE}, orderBy: id,
+                       where: {{{address_field}_in: $addresses, id_gt: $lastId}}) {{
+        id {address_field} blockTime cTokenSymbol amount
+      }}
+    }}"""
+    events, last_id = [], ""
+    while True:
+        payload = {'query': query, 'variables': {'addresses': addresses, 'lastId': last_id}}
+        async with session.post(COMPOUND_V2_SUBGRAPH_URL, json=payload) as response:
+            response.raise_for_status()
+            data = orjson.loads(await response.read())
+        if data.get('errors'):
+            raise RuntimeError(f"Compound V2 subgraph error: {data['errors']}")
+
+        try:
+            page = data['data']['events']
+        except (KeyError, TypeError):
+            raise RuntimeError(f"Malformed Compound V2 subgraph response: {str(data)[:200]}") from None
+        events.extend(page)
+        if len(page) < SUBGRAPH_CHUNK_SIZE:
+            return events
+        last_id = page[-1]['id']
+
+
+async def fetch_transactions_bulk(session: aiohttp.ClientSession, wallet_addresses: list) -> list:
+    """Fetches Compound V2 activity for all wallets from the subgraph in a few bulk queries.
+
+    supplied_usd is computed exactly as in summarize_transactions (cToken amount in raw units divided by
+    the underlying decimals, times the price), so both sources feed the same quantity into scoring.
+    The event sets still differ: the subgraph only sees protocol mints and redeems, while the Etherscan
+    path also counts plain cToken transfers in and out of the wallet, so scores can differ for wallets
+    that move cTokens directly. Raises RuntimeError on a malformed response.
+    """
+    print(f"Fetching Compound V2 events for {len(wallet_addresses)} wallets from the subgraph...")
+    addresses = [address.lower() for address in wallet_addresses]
+    activity = {address: empty_summary() for address in addresses}
+
+    for start in range(0, len(addresses), SUBGRAPH_CHUNK_SIZE):
+        chunk = addresses[start:start + SUBGRAPH_CHUNK_SIZE]
+        # Mints are keyed by the receiving wallet, redeems by the sending wallet
+        for entity, address_field in (('mintEvents', 'to'), ('redeemEvents', 'from')):
+            for event in await query_subgraph_events(session, entity, address_field, chunk):
+                token_info = _CTOKEN_BY_SYMBOL.get(event.get('cTokenSymbol'))
+                # Only process the supported Compound V2 cTokens
+                if token_info is None:
+                    continue
+                try:
+                    wallet = activity[event[address_field]]
+                    # amount is in whole cTokens; scale to raw units to match the Etherscan transfer value
+                    raw_value = float(event['amount']) * 10 ** _CTOKEN_TRANSFER_DECIMALS
+                    block_time = int(event['blockTime'])
+                except (KeyError, TypeError, ValueError):
+                    raise RuntimeError(f"Malformed Compound V2 subgraph {entity} entry: {event}") from None
+                if entity == 'mintEvents':
+                    wallet['supplied_usd'] += raw_value / 10 ** token_info['underlying_decimals'] * token_info['price_usd']
+                wallet['min_ts'] = block_time if wallet['min_ts'] is None else min(wallet['min_ts'], block_time)
+                wallet['asset_mask'] |= 1 << _CTOKEN_SYMBOL_CODE[event['cTokenSymbol']]
+                wallet['n_tx'] += 1
+
+    return [activity[address] for address in addresses]
+
+
+def calculate_features(summary: dict, now: Optional[int] = None) -> dict:
+    """Calculates risk features from a wallet's transaction summary, with wallet age measured up to `now`."""
+    if summary['n_tx'] == 0:
         return {'liquidation_count': 0, 'total_supplied_usd': 0, 'total_borrowed_usd': 0,
                 'total_liquidated_usd': 0, 'distinct_assets_borrowed': 0, 'wallet_age_days': 0}
 
     # Calculate total supplied (mint transactions)
-    total_supplied_usd = df[df['event_type'] == 'Mint']['value_usd'].sum()
+    total_supplied_usd = summary['supplied_usd']
     # Estimate borrowed amount (40% of supplied)
     total_borrowed_usd = total_supplied_usd * 0.4
-    # Calculate wallet age
-    wallet_age_days = (datetime.now() - df['timestamp'].min()).days
+    # Calculate wallet age from the first Compound transaction (integer Unix seconds throughout)
+    if now is None:
+        now = int(time.time())
+    wallet_age_days = (now - summary['min_ts']) // 86400
 
     return {
         'liquidation_count': 0,
         'total_supplied_usd': total_supplied_usd,
         'total_borrowed_usd': total_borrowed_usd,
         'total_liquidated_usd': 0,
-        'distinct_assets_borrowed': df['asset_symbol'].nunique(),
+        'distinct_assets_borrowed': bin(summary['asset_mask']).count('1'),
         'wallet_age_days': wallet_age_days
     }
 
 
-def generate_risk_scores(wallets_file: str, api_key: str) -> pd.DataFrame:
-    """Main function to process wallets and generate risk scores using parallel fetching."""
+def generate_risk_scores(wallets_file: str, api_key: str, use_subgraph: bool = False,
+                         cache_path: Optional[str] = 'etherscan_cache',
+                         filter_server_side: bool = False) -> pd.DataFrame:
+    """Main function to process wallets and generate risk scores using concurrent async fetching.
+
+    With use_subgraph=True, wallet activity is fetched in bulk from the Compound V2 subgraph,
+    falling back to per-wallet Etherscan requests if the subgraph query fails.
+    Etherscan results are cached on disk at cache_path (a shelve database); pass None to disable.
+    With filter_server_side=True, Etherscan is queried once per cToken per wallet (see
+    fetch_real_transactions_async): more requests, but far smaller responses.
+    """
     wallet_addresses = get_wallet_addresses(wallets_file)
     if not wallet_addresses: return pd.DataFrame()
     if not api_key:
         print("🚨 Error: Etherscan API Key not found. Make sure it's in your .env file.")
         return pd.DataFrame()
 
-    # Fetch transactions for all wallets in parallel
-    all_transactions = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        tasks = [(address, api_key) for address in wallet_addresses]
-        results = executor.map(fetch_wallet_data_wrapper, tasks)
-        for address, transactions_df in results:
-            all_transactions[address] = transactions_df
-            if not transactions_df.empty:
-                print(f"  > Successfully processed {len(transactions_df)} transactions for {address}.")
-            else:
-                print(f"  > No relevant Compound transactions found for {address}.")
-
-    # Calculate features for each wallet
-    features_list = []
-    for address in wallet_addresses:
-        transactions_df = all_transactions.get(address, pd.DataFrame())
-        features = calculate_features(transactions_df)
-        features['wallet_id'] = address
-        features_list.append(features)
-
-    features_df = pd.DataFrame(features_list)
-    # Calculate health factor proxy (borrowed/supplied ratio)
-    features_df['health_factor_proxy'] = features_df['total_borrowed_usd'] / (features_df['total_supplied_usd'] + 1e-6)
-
-    # Normalize features for scoring
     feature_columns = ['liquidation_count', 'health_factor_proxy', 'total_liquidated_usd', 'distinct_assets_borrowed',
                        'wallet_age_days']
-    scaler = MinMaxScaler()
-    normalized_features = scaler.fit_transform(features_df[feature_columns])
-    normalized_df = pd.DataFrame(normalized_features, columns=feature_columns)
+    # Etherscan free tier allows 5 requests per second; paid keys can raise it via ETHERSCAN_RPS
+    try:
+        requests_per_second = get_requests_per_second()
+    except ValueError as e:
+        print(f"🚨 Error: {e}")
+        return pd.DataFrame()
+
+    # All wallets are aged against the same reference time
+    now = int(time.time())
+    # Feature matrix filled by wallet position, so output order matches the input file
+    X = np.zeros((len(wallet_addresses), len(feature_columns)), dtype=np.float64)
+    # Wallets whose data could not be fetched are left out of scoring rather than scored as inactive
+    fetched = np.zeros(len(wallet_addresses), dtype=bool)
+
+    def _add_wallet(i, summary):
+        address = wallet_addresses[i]
+        if summary is None:
+            return
+        fetched[i] = True
+        if summary['n_tx']:
+            print(f"  > Successfully processed {summary['n_tx']} transactions for {address}.")
+        else:
+            print(f"  > No relevant Compound transactions found for {address}.")
+        features = calculate_features(summary, now)
+        # Calculate health factor proxy (borrowed/supplied ratio)
+        features['health_factor_proxy'] = features['total_borrowed_usd'] / (features['total_supplied_usd'] + 1e-6)
+        X[i] = [features[col] for col in feature_columns]
+
+    async def _fetch(session, limiter, cache, i, address):
+        try:
+            return i, await fetch_real_transactions_async(session, limiter, address, api_key, cache, filter_server_side)
+        except EtherscanError as e:
+            print(f"  > 🚨 Skipping {address}, its transactions could not be fetched: {e}")
+            return i, None
+
+    async def _run(cache):
+        # Rates below 1/s are expressed as one request per 1/rate seconds, since each acquire takes a full token
+        if requests_per_second >= 1:
+            limiter = AsyncLimiter(max_rate=requests_per_second, time_period=1.0)
+        else:
+            limiter = AsyncLimiter(max_rate=1, time_period=1 / requests_per_second)
+        # Concurrency is sized to hide latency (twice the rate), the limiter alone enforces the rate
+        max_connections = max(1, int(2 * requests_per_second))
+        # One pooled keep-alive session shared by every request
+        connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections, keepalive_timeout=60)
+        # Bound connecting and each socket read, not the whole request: a total would also count the
+        # wait for a free pooled connection and the download of a large (up to 10,000 row) response
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            if use_subgraph:
+                try:
+                    summaries = await fetch_transactions_bulk(session, wallet_addresses)
+                except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError, RuntimeError) as e:
+                    print(f"  > Subgraph query failed ({e!r}), falling back to Etherscan.")
+                else:
+                    for i, summary in enumerate(summaries):
+                        _add_wallet(i, summary)
+                    return
+            # Features are calculated as each wallet completes, while other requests are still in flight
+            for next_result in asyncio.as_completed(
+                    [_fetch(session, limiter, cache, i, address) for i, address in enumerate(wallet_addresses)]):
+                _add_wallet(*await next_result)
+
+    # Fetch transactions and calculate features for all wallets concurrently
+    with (shelve.open(cache_path) if cache_path else nullcontext()) as cache:
+        asyncio.run(_run(cache))
+
+    failed_wallets = [address for address, ok in zip(wallet_addresses, fetched) if not ok]
+    if failed_wallets:
+        print(f"🚨 Error: {len(failed_wallets)} wallet(s) could not be fetched and are excluded from the scores: "
+              f"{', '.join(failed_wallets)}")
+    if not fetched.any():
+        return pd.DataFrame()
+    X = X[fetched]
+    scored_wallets = [address for address, ok in zip(wallet_addresses, fetched) if ok]
+
+    # Normalize features for scoring (min-max to 0-1; constant columns map to 0)
+    mn = X.min(axis=0)
+    rng = np.maximum(X.max(axis=0) - mn, 1e-12)
+    normalized = (X - mn) / rng
 
     # Invert wallet age (newer wallets = higher risk)
-    if 'wallet_age_days' in normalized_df.columns:
-        normalized_df['wallet_age_days'] = 1 - normalized_df['wallet_age_days']
+    age_idx = feature_columns.index('wallet_age_days')
+    normalized[:, age_idx] = 1 - normalized[:, age_idx]
 
-    # Apply weights to calculate final risk score
+    # Apply weights to calculate final risk score (ordered to match feature_columns)
     weights = {'liquidation_count': 0.40, 'health_factor_proxy': 0.30, 'total_liquidated_usd': 0.15,
                'distinct_assets_borrowed': 0.10, 'wallet_age_days': 0.05}
-    final_score = sum(normalized_df[col] * weights[col] for col in weights if col in normalized_df)
+    weights_vec = np.array([weights[col] for col in feature_columns])
+    final_score = normalized @ weights_vec
 
     # Create final results dataframe
-    final_df = pd.DataFrame({'wallet_id': features_df['wallet_id'], 'score': (final_score * 1000).astype(int)})
+    final_df = pd.DataFrame({'wallet_id': scored_wallets, 'score': (final_score * 1000).astype(int)})
     return final_df
 
 
 if __name__ == "__main__":
     start_time = time.time()
 
+    # Only the command-line entry point reads the .env file; library callers pass the key explicitly
+    from dotenv import load_dotenv
+    load_dotenv()
+    ETHERSCAN_API_KEY = os.getenv("ETHERSCAN_API_KEY")
+
     INPUT_CSV_PATH = 'wallets.csv'
     OUTPUT_CSV_PATH = 'wallet_risk_scores.csv'
 
@@ -194,7 +498,7 @@ if __name__ == "__main__":
     if not risk_scores_df.empty:
         risk_scores_df.to_csv(OUTPUT_CSV_PATH, index=False)
         print("\n" + "=" * 50)
-        print(f"✅ Successfully generated risk scores for 104 wallets.")
+        print(f"✅ Successfully generated risk scores for {len(risk_scores_df)} wallets.")
         print(f"Results saved to '{OUTPUT_CSV_PATH}'")
 
         end_time = time.time()